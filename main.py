@@ -1,16 +1,23 @@
 import os
 import asyncio
+import atexit
+import contextlib
+import errno
 import logging
-import json
 import re
 import shutil
+import subprocess
+import time
 from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
+from queue import SimpleQueue
 from typing import Optional, Dict
 from dotenv import load_dotenv
 
 import interactions
-from interactions.api.voice.audio import Audio
+import orjson
+from interactions.api.voice.audio import BaseAudio
 import redis.asyncio as redis
 import uuid
 
@@ -19,6 +26,42 @@ load_dotenv()
 
 
 # region Constants and Configuration
+def decode_audio(path: Path) -> bytes:
+    """Decode an audio file to the 48kHz stereo PCM the voice player sends."""
+    cmd = ["ffmpeg", "-loglevel", "warning", "-i", str(path)]
+    cmd += ["-f", "s16le", "-ar", "48000", "-ac", "2", "pipe:1"]
+    return subprocess.run(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+
+
+class PcmAudio(BaseAudio):
+    """Plays pre-decoded PCM from memory; create one instance per playback."""
+
+    def __init__(self, pcm: bytes):
+        self.pcm = memoryview(pcm)
+        self.position = 0
+        self.needs_encode = True
+        self.locked_stream = False
+
+    @property
+    def audio_complete(self) -> bool:
+        return self.position >= len(self.pcm)
+
+    def read(self, frame_size: int) -> bytes:
+        data = bytes(self.pcm[self.position : self.position + frame_size])
+        self.position += frame_size
+        if 0 < len(data) < frame_size:
+            data += b"\0" * (frame_size - len(data))
+        return data
+
+    def cleanup(self) -> None:
+        pass
+
+
 class Config:
     BOT_TOKEN = os.getenv("BOT_TOKEN")
     AUDIOS_DIR = Path("audio")
@@ -28,20 +71,32 @@ class Config:
     REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
     REDIS_DB = int(os.getenv("REDIS_DB", "0"))
 
+    # Minimum seconds between error sounds for rejected audio in a guild
+    ERROR_COOLDOWN = int(os.getenv("ERROR_COOLDOWN", "30"))
+    # Maximum recordings moved into the audio directory at the same time
+    MAX_CONCURRENT_MOVES = int(os.getenv("MAX_CONCURRENT_MOVES", "8"))
+
     MESSAGE_FILES = {
-        "start": Audio(Path("messages/start-recording.wav")),
-        "stop": Audio(Path("messages/stop-recording.wav")),
-        "error": Audio(Path("messages/error-message.wav")),
+        "start": decode_audio(Path("messages/start-recording.wav")),
+        "stop": decode_audio(Path("messages/stop-recording.wav")),
+        "error": decode_audio(Path("messages/error-message.wav")),
     }
 
     QUEUE_CONFIGURATION = {
         "AudioQueue": os.getenv("AUDIO_QUEUE").encode(),
         "RejectedAudioQueue": os.getenv("REJECTED_AUDIO_QUEUE").encode(),
         "ProcessedAudioQueue": os.getenv("PROCESSED_AUDIO_QUEUE").encode(),
+        "ConsentUpdateQueue": os.getenv(
+            "CONSENT_UPDATE_QUEUE", "consent:update"
+        ).encode(),
     }
 
 
 Config.AUDIOS_DIR.mkdir(parents=True, exist_ok=True)
+CONSENT_RE = re.compile(r"^consent_(allow|deny)_(\d+)$")
+SAFE_NAME_RE = re.compile(r"[^\w\-_]")
+# Larger buffer for the cross-device copy fallback in process_user_recording
+shutil.COPY_BUFSIZE = 256 * 1024
 
 
 # region Logging Configuration
@@ -56,11 +111,18 @@ def setup_logging() -> logging.Logger:
 
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
 
     file_handler = logging.FileHandler("logs.log")
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+
+    # Handlers run on a background thread so log writes don't block the event loop
+    log_queue = SimpleQueue()
+    logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(
+        log_queue, console_handler, file_handler, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
 
     return logger
 
@@ -68,8 +130,13 @@ def setup_logging() -> logging.Logger:
 logger = setup_logging()
 # endregion
 
+# Keep raw bytes responses so pubsub channels compare directly against
+# Config.QUEUE_CONFIGURATION without a per-message decode
 redis_client = redis.Redis(
-    host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB
+    host=Config.REDIS_HOST,
+    port=Config.REDIS_PORT,
+    db=Config.REDIS_DB,
+    decode_responses=False,
 )
 
 
@@ -77,8 +144,12 @@ redis_client = redis.Redis(
 class VoiceStateManager:
     """Manages active voice recordings across guilds."""
 
+    __slots__ = ("active_recordings", "safe_name_cache")
+
     def __init__(self):
         self.active_recordings: Dict[int, interactions.ActiveVoiceState] = {}
+        # guild id -> {username: safe name}; dropped when the guild stops recording
+        self.safe_name_cache: Dict[int, Dict[str, str]] = {}
 
     def add(self, guild_id: int, voice_state: interactions.ActiveVoiceState) -> None:
         self.active_recordings[guild_id] = voice_state
@@ -89,6 +160,17 @@ class VoiceStateManager:
     def get(self, guild_id: int) -> Optional[interactions.ActiveVoiceState]:
         return self.active_recordings.get(guild_id)
 
+    def safe_name(self, guild_id: int, member: interactions.Member) -> str:
+        """Return a filesystem-safe directory name for a member."""
+        names = self.safe_name_cache.setdefault(guild_id, {})
+        if (name := names.get(member.username)) is None:
+            name = SAFE_NAME_RE.sub("_", member.username).strip("_")[:64]
+            names[member.username] = name
+        return name
+
+    def forget_safe_names(self, guild_id: int) -> None:
+        self.safe_name_cache.pop(guild_id, None)
+
 
 voice_state_manager = VoiceStateManager()
 
@@ -96,35 +178,66 @@ voice_state_manager = VoiceStateManager()
 class ConsentManager:
     """Manages user consent storage and retrieval."""
 
+    __slots__ = ("_cache", "_mtime", "consent_file")
+
     def __init__(self, consent_file: Path):
         self.consent_file = consent_file
+        self._cache: Optional[Dict[str, bool]] = None
+        self._mtime: int = -1
 
     def load(self) -> Dict[str, bool]:
-        """Load consent data from JSON file."""
-        if not self.consent_file.exists():
+        """Load a copy of consent data, re-reading the file only if it changed."""
+        try:
+            mtime = self.consent_file.stat().st_mtime_ns
+        except FileNotFoundError:
             return {}
 
+        if mtime == self._mtime and self._cache is not None:
+            return dict(self._cache)
+
         try:
-            with open(self.consent_file, "r", encoding="utf-8") as f:
-                return json.load(f)
+            self._cache = orjson.loads(self.consent_file.read_bytes())
+            self._mtime = mtime
+            return dict(self._cache)
         except Exception:
             logger.exception("Failed to load consent data")
             return {}
 
+    def invalidate(self) -> None:
+        """Force the next load to re-read the consent file."""
+        self._mtime = -1
+
     def save(self, data: Dict[str, bool]) -> None:
         """Save consent data to JSON file."""
         try:
-            with open(self.consent_file, "w", encoding="utf-8") as f:
-                json.dump(data, f, indent=4)
+            self.consent_file.write_bytes(
+                orjson.dumps(data, option=orjson.OPT_INDENT_2)
+            )
+            self._cache = dict(data)
+            self._mtime = self.consent_file.stat().st_mtime_ns
         except Exception:
             logger.exception("Failed to save consent data")
 
+    async def broadcast_update(self) -> None:
+        """Tell other bot processes to drop their cached consent data."""
+        try:
+            await redis_client.publish(
+                Config.QUEUE_CONFIGURATION["ConsentUpdateQueue"], PROCESS_ID
+            )
+        except Exception:
+            logger.exception("Failed to broadcast consent update")
+
 
 consent_manager = ConsentManager(Config.CONSENT_FILE)
+# Identifies this process's own consent broadcasts so it doesn't act on them
+PROCESS_ID = uuid.uuid4().hex.encode()
 # endregion
 
 
 # region Core Functionality
+move_semaphore = asyncio.Semaphore(Config.MAX_CONCURRENT_MOVES)
+
+
 async def request_consent(
     ctx: interactions.SlashContext, member: interactions.Member
 ) -> None:
@@ -146,7 +259,7 @@ async def request_consent(
         await member.send("¿Consientes en que te robemos tu audio?", components=buttons)
     except Exception:
         logger.warning(
-            f"Couldn't DM {member.username}, falling back to channel message"
+            "Couldn't DM %s, falling back to channel message", member.username
         )
         await ctx.channel.send(
             f"{member.mention}, ¿Consientes en que te robemos tu audio? Responde aquí:",
@@ -157,14 +270,17 @@ async def request_consent(
 async def process_user_recording(
     ctx: interactions.SlashContext,
     user_id: int,
-    file_path: Path,
+    file_path: str,
     consent_data: Dict[str, bool],
     channel_id: int,
-) -> Optional[Path]:
-    """Process a single user's recording and return transcript path."""
+    timestamp: str,
+    pipe: redis.client.Pipeline,
+) -> Optional[str]:
+    """Process a single user's recording and queue its publish on ``pipe``."""
     if not consent_data.get(str(user_id), False):
-        file_path.unlink(missing_ok=True)
-        logger.info(f"Deleted unconsented recording from {user_id}")
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(file_path)
+        logger.info("Deleted unconsented recording from %s", user_id)
         return None
 
     member = ctx.guild.get_member(user_id)
@@ -172,21 +288,26 @@ async def process_user_recording(
         return None
 
     # Create user directory
-    safe_name = re.sub(r"[^\w\-_]", "_", member.username).strip("_")[:64]
-    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d-%H-%M")
-    user_dir = Config.AUDIOS_DIR / safe_name / timestamp
-    user_dir.mkdir(parents=True, exist_ok=True)
+    safe_name = voice_state_manager.safe_name(ctx.guild_id, member)
+    user_dir = os.path.join(Config.AUDIOS_DIR, safe_name, timestamp)
+    os.makedirs(user_dir, exist_ok=True)
 
     # Move recording to user directory
-    identifier = str(uuid.uuid4())
-    dest_path = (user_dir / f"{identifier}-{timestamp}").with_suffix(".wav")
-    shutil.move(file_path, dest_path)
-    await redis_client.publish(
+    identifier = uuid.uuid4().hex
+    dest_path = os.path.join(user_dir, f"{identifier}-{timestamp}.wav")
+    async with move_semaphore:
+        try:
+            os.replace(file_path, dest_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            await asyncio.to_thread(shutil.move, file_path, dest_path)
+    pipe.publish(
         Config.QUEUE_CONFIGURATION["AudioQueue"],
-        json.dumps(
+        orjson.dumps(
             {
                 "id": identifier,
-                "path": str(dest_path),
+                "path": dest_path,
                 "userId": user_id,
                 "user": member.username,
                 "channelId": channel_id,
@@ -197,6 +318,62 @@ async def process_user_recording(
     return dest_path
 
 
+async def process_recordings(
+    ctx: interactions.SlashContext, voice_state: interactions.ActiveVoiceState
+) -> int:
+    """Process all finished recordings and return how many were kept."""
+    # Snapshot before awaiting so late writes from voice threads can't race us
+    recordings = list(voice_state.recorder.output.items())
+    voice_state.recorder.output.clear()
+
+    consent_data = consent_manager.load()
+    channel_id = voice_state.channel.id
+    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d-%H-%M")
+    pipe = redis_client.pipeline(transaction=False)
+    tasks = [
+        process_user_recording(
+            ctx, user_id, file_path, consent_data, channel_id, timestamp, pipe
+        )
+        for user_id, file_path in recordings
+    ]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    successful = 0
+    for (user_id, _), result in zip(recordings, results):
+        if isinstance(result, Exception):
+            logger.error("Error processing recording from %s", user_id, exc_info=result)
+        elif result is not None:
+            successful += 1
+
+    flush_pipeline_no_wait(pipe)
+    return successful
+
+
+pending_publishes: set[asyncio.Task] = set()
+
+
+async def flush_pipeline(pipe: redis.client.Pipeline) -> None:
+    """Send queued publishes and release the pipeline."""
+    try:
+        async with pipe:
+            await pipe.execute()
+    except Exception:
+        logger.exception("Failed to publish recordings")
+
+
+def flush_pipeline_no_wait(pipe: redis.client.Pipeline) -> asyncio.Task:
+    """Send queued publishes in the background without waiting for Redis."""
+    task = asyncio.create_task(flush_pipeline(pipe))
+    pending_publishes.add(task)
+    task.add_done_callback(pending_publishes.discard)
+    return task
+
+
+async def drain_pending_publishes() -> None:
+    """Wait for every background publish to reach Redis."""
+    await asyncio.gather(*pending_publishes)
+
+
 # endregion
 
 # region Bot Setup
@@ -208,16 +385,13 @@ bot = interactions.Client(
     logger=logger,
 )
 
-queue = redis_client.pubsub()
+queue = redis_client.pubsub(ignore_subscribe_messages=True)
 
 
-@interactions.component_callback(
-    re.compile(r"consent_allow_*"), re.compile(r"consent_deny_*")
-)
+@interactions.component_callback(CONSENT_RE)
 async def handle_consent_response(ctx: interactions.ComponentContext):
     """Handle consent response from users."""
-    custom_id = ctx.custom_id
-    _, action, user_id = custom_id.split("_")
+    action, user_id = CONSENT_RE.match(ctx.custom_id).groups()
 
     if ctx.user.id != int(user_id):
         await ctx.send("No puedes responder a esta solicitud.", ephemeral=True)
@@ -227,7 +401,9 @@ async def handle_consent_response(ctx: interactions.ComponentContext):
     consent_data[user_id] = action == "allow"
     consent_manager.save(consent_data)
 
+    # Acknowledge before touching Redis so a slow broker can't fail the interaction
     await ctx.send("Tu preferencia ha sido guardada.", ephemeral=True)
+    await consent_manager.broadcast_update()
 
 
 @interactions.Task.create(interactions.IntervalTrigger(minutes=int(os.getenv("TRANSCRIPTION_INTERVAL", 15))))
@@ -235,21 +411,12 @@ async def scheduled_transcription_task(ctx: interactions.SlashContext):
     """Scheduled task to process recordings every specified interval."""
 
     if voice_state := voice_state_manager.get(ctx.guild_id):
-        logger.info(f"Processing recordings in guild {ctx.guild_id}")
+        logger.info("Processing recordings in guild %s", ctx.guild_id)
         try:
             await voice_state.stop_recording()
-            consent_data = consent_manager.load()
-            channel_id = voice_state.channel.id
-            tasks = [
-                process_user_recording(
-                    ctx, user_id, Path(file_path), consent_data, channel_id
-                )
-                for user_id, file_path in voice_state.recorder.output.items()
-            ]
-            recording_paths = await asyncio.gather(*tasks)
-            successful = sum(1 for t in recording_paths if t is not None)
+            successful = await process_recordings(ctx, voice_state)
 
-            logger.info(f"Processed {successful} recording_paths in {ctx.guild_id}")
+            logger.info("Processed %d recordings in %s", successful, ctx.guild_id)
 
             await voice_state.start_recording(
                 output_dir=Config.AUDIOS_DIR, encoding="wav"
@@ -259,7 +426,7 @@ async def scheduled_transcription_task(ctx: interactions.SlashContext):
             logger.exception("Error processing recordings")
             await ctx.send("Error al procesar las grabaciones", ephemeral=True)
             if voice_state.connected:
-                await voice_state.play(Config.MESSAGE_FILES["error"])
+                await voice_state.play(PcmAudio(Config.MESSAGE_FILES["error"]))
                 await voice_state.disconnect()
 
 
@@ -280,7 +447,7 @@ async def start_recording(ctx: interactions.SlashContext):
         voice_state = await ctx.author.voice.channel.connect()
         await voice_state.start_recording(output_dir=Config.AUDIOS_DIR, encoding="wav")
         voice_state_manager.add(ctx.guild_id, voice_state)
-        voice_state.play_no_wait(Config.MESSAGE_FILES["start"])
+        voice_state.play_no_wait(PcmAudio(Config.MESSAGE_FILES["start"]))
 
         # Request consent from new members
         consent_data = consent_manager.load()
@@ -290,8 +457,17 @@ async def start_recording(ctx: interactions.SlashContext):
             if not m.bot and str(m.id) not in consent_data
         ]
 
-        for member in members_needing_consent:
-            await request_consent(ctx, member)
+        results = await asyncio.gather(
+            *(request_consent(ctx, m) for m in members_needing_consent),
+            return_exceptions=True,
+        )
+        for member, result in zip(members_needing_consent, results):
+            if isinstance(result, Exception):
+                logger.error(
+                    "Failed to request consent from %s",
+                    member.username,
+                    exc_info=result,
+                )
 
         await ctx.send("🎙️ Grabación iniciada!")
         scheduled_transcription_task.start(ctx)
@@ -300,7 +476,7 @@ async def start_recording(ctx: interactions.SlashContext):
         logger.exception("Error starting recording")
         await ctx.send("Error al iniciar la grabación", ephemeral=True)
         if voice_state := voice_state_manager.get(ctx.guild_id):
-            await voice_state.play(Config.MESSAGE_FILES["error"])
+            await voice_state.play(PcmAudio(Config.MESSAGE_FILES["error"]))
             await voice_state.disconnect()
 
 
@@ -316,52 +492,76 @@ async def stop_recording(ctx: interactions.SlashContext):
     try:
         scheduled_transcription_task.stop()
         await voice_state.stop_recording()
-        task = voice_state.play_no_wait(Config.MESSAGE_FILES["stop"])
+        task = voice_state.play_no_wait(PcmAudio(Config.MESSAGE_FILES["stop"]))
 
         # Process remaining recordings
-        consent_data = consent_manager.load()
-        tasks = [
-            process_user_recording(
-                ctx, user_id, Path(file_path), consent_data, voice_state.channel.id
-            )
-            for user_id, file_path in voice_state.recorder.output.items()
-        ]
-
-        recording_paths = await asyncio.gather(*tasks)
-        successful = sum(1 for t in recording_paths if t is not None)
+        successful = await process_recordings(ctx, voice_state)
 
         await ctx.send(f"⏹️ Grabación detenida. Procesadas {successful} grabaciones")
         await task
+        await drain_pending_publishes()
         await voice_state.disconnect()
 
     except Exception:
         logger.exception("Error stopping recording")
         await ctx.send("Error al detener la grabación", ephemeral=True)
         if voice_state.connected:
-            await voice_state.play(Config.MESSAGE_FILES["error"])
+            await voice_state.play(PcmAudio(Config.MESSAGE_FILES["error"]))
             await voice_state.disconnect()
+    finally:
+        voice_state_manager.forget_safe_names(ctx.guild_id)
+
+
+last_error_played: Dict[int, float] = {}
+
+
+async def handle_rejected_audio(message: dict) -> None:
+    """Play the error sound in the guild whose audio was rejected."""
+    try:
+        guild_id = int(message["data"])
+    except ValueError:
+        # Producers not yet updated still send {"guildId": ...} as JSON
+        try:
+            guild_id = int(orjson.loads(message["data"])["guildId"])
+        except (orjson.JSONDecodeError, TypeError, KeyError, ValueError):
+            logger.warning("Dropping malformed rejected-audio message %r", message)
+            return
+    now = time.monotonic()
+    last_played = last_error_played.get(guild_id)
+    if last_played is not None and now - last_played < Config.ERROR_COOLDOWN:
+        return
+    if voice_state := voice_state_manager.get(guild_id):
+        if not voice_state.connected:
+            return
+        last_error_played[guild_id] = now
+        voice_state.play_no_wait(PcmAudio(Config.MESSAGE_FILES["error"]))
+
+
+async def handle_consent_update(message: dict) -> None:
+    """Drop cached consent data after another process saved it."""
+    if message["data"] != PROCESS_ID:
+        consent_manager.invalidate()
+
+
+QUEUE_HANDLERS = {
+    Config.QUEUE_CONFIGURATION["RejectedAudioQueue"]: handle_rejected_audio,
+    Config.QUEUE_CONFIGURATION["ConsentUpdateQueue"]: handle_consent_update,
+}
 
 
 @interactions.listen()
 async def on_ready():
-    logger.info(f"Logged in as {bot.user.username}#{bot.user.discriminator}")
-    await queue.subscribe(Config.QUEUE_CONFIGURATION["RejectedAudioQueue"])
-    counter = 0
-    async for message in queue.listen():
-        if message["type"] != "message":
+    logger.info("Logged in as %s#%s", bot.user.username, bot.user.discriminator)
+    await queue.subscribe(*QUEUE_HANDLERS)
+    while True:
+        message = await queue.get_message(timeout=1.0)
+        if message is None:
             continue
-        body = json.loads(message["data"])
-        if message["channel"] == Config.QUEUE_CONFIGURATION["RejectedAudioQueue"]:
-            if counter != 7:
-                continue
-            if voice_state := voice_state_manager.get(body["guildId"]):
-                voice_state.current_audio
-                if not voice_state.connected:
-                    continue
-                await voice_state.play(Config.MESSAGE_FILES["error"])
-                counter = 0
-
-        counter += 1
+        if handler := QUEUE_HANDLERS.get(message["channel"]):
+            try:
+                await handler(message)
+            except Exception:
+                logger.exception("Error handling message on %s", message["channel"])
 
 
 # Handle voice user join event
@@ -389,26 +589,36 @@ async def on_voice_user_leave(event: interactions.events.VoiceUserLeave):
     if not voice_state or event.channel.id != voice_state.channel.id:
         return
 
-    consent_data = consent_manager.load()
     remaining = [
-        m
-        for m in event.channel.members
-        if not m.bot and str(m.id) in consent_data and m.id != event.author.id
+        m for m in event.channel.members if not m.bot and m.id != event.author.id
     ]
+    if remaining:
+        consent_data = consent_manager.load()
+        remaining = [m for m in remaining if str(m.id) in consent_data]
     if not remaining:
         scheduled_transcription_task.stop()
         await voice_state.disconnect()
         voice_state_manager.remove(event.channel.guild.id)
+        voice_state_manager.forget_safe_names(event.channel.guild.id)
         await event.channel.send("Todos los miembros han abandonado el canal.")
 
 
 # endregion
 
+
 # region Main Execution
+async def run_bot() -> None:
+    """Run the bot, flushing queued recordings on its loop before it closes."""
+    try:
+        await bot.astart()
+    finally:
+        await drain_pending_publishes()
+
+
 if __name__ == "__main__":
     try:
         logger.info("Starting bot...")
-        bot.start()
+        asyncio.run(run_bot())
     except KeyboardInterrupt:
         logger.info("Shutting down bot...")
     finally: